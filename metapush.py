@@ -21,8 +21,9 @@ etc.) with general and geometry related information. However the
 architecture is intended to be expandable for other targets (ISO19139,
 ISO Feature Catalog) and sources (JSON, YAML etc.).
 
-Forgo use of lxml because it's hard to install in some restricted
-environments.
+Forgo requiring lxml because it's hard to install in some restricted
+environments, but use it if it's available, falling back to
+cElementTree.
 
 FIXME: do_update overwrites content with blanks, should it not do
 that, or should user supply inputs in sensible order (populated
@@ -34,12 +35,29 @@ Terry Brown, Terry_N_Brown@yahoo.com, Mon Feb 15 21:20:33 2016
 """
 
 import argparse
-from copy import deepcopy
 import csv
+import multiprocessing
 import os
 from pprint import pprint
 import sys
-from xml.etree import ElementTree
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir  # Python 2 backport
+    except ImportError:
+        scandir = None
+try:
+    # fastest, but optional, see docs. above
+    from lxml import etree as ElementTree
+    LXML = True
+except ImportError:
+    LXML = False
+    try:
+        # C accelerated version, much faster parsing of large templates
+        import xml.etree.cElementTree as ElementTree
+    except ImportError:
+        from xml.etree import ElementTree
 
 KEY_ALIASES = {
     'entity_name': [
@@ -58,26 +76,96 @@ KEY_ALIASES = {
     'max': ['maximum', ],
     'units': ['unit', ],
 }
+BUFFER_SIZE = 1 << 20  # for file I/O, fewer larger reads / writes
+_TEXT_TYPES = (str, unicode)  # scalar values, see do_update()
+# alias (or canonical key) -> canonical key, built in reverse so the first
+# canonical key listing an alias wins, as when scanning KEY_ALIASES
+_ALIAS2CANON = {
+    alias: canon for canon, aliases in reversed(list(KEY_ALIASES.items()))
+    for alias in aliases
+}
+_ALIAS2CANON.update({k: k for k in KEY_ALIASES})
+# canonical key -> keys to check for it, exact match first
+_CANON_KEYS = {k: (k,) + tuple(v) for k, v in KEY_ALIASES.items()}
+# attribute level content read from ArcGIS <attr> elements, child paths
+ARCGIS_READ_PATHS = (
+    ('min', 'attrdomv/rdom/rdommin'),
+    ('max', 'attrdomv/rdom/rdommax'),
+    ('units', 'attrdomv/rdom/attrunit'),
+    ('attribute_definition', 'attrdef'),
+)
+# attribute level content written to ArcGIS <attr> elements, pre-split
+ARCGIS_WRITE_PATHS = tuple((attrname, tuple(attrpath.split('/')))
+    for attrname, attrpath in (
+        ('attribute_type', 'attrtype'),
+        ('attribute_definition', 'attrdef'),
+        ('min', 'attrdomv/rdom/rdommin'),
+        ('max', 'attrdomv/rdom/rdommax'),
+        ('units', 'attrdomv/rdom/attrunit'),
+    )
+)
+# descendant search for ArcGIS entities, compiled once under lxml, other
+# lookups are child paths, which ElementTree and lxml both cache
+XPATH_DETAILED = ElementTree.XPath('.//eainfo/detailed') if LXML else None
+# libxml2 refuses text nodes over 10MB by default, ArcGIS metadata can
+# hold bigger base64 thumbnails / enclosures
+PARSE_KWARGS = (
+    {'parser': ElementTree.XMLParser(huge_tree=True)} if LXML else {})
+ITERPARSE_KWARGS = {'huge_tree': True} if LXML else {}
 class HandlerBase(object):
     """HandlerBase - base class for base classes which collect
-    registrations of subclasses to handle different inputs. Defines
-    a metaclass to do subclass registration, and handle() to select
-    a subclass.  Subclasses should redefine handle() to determine
-    if they handle a particular input.
+    subclasses to handle different inputs.  Defines handlers() to list
+    subclasses, and handle() to select one.  Subclasses should redefine
+    handle() to determine if they handle a particular input, and may
+    list `probe_keys`, values of the base class's cheap probe() of the
+    input, so their handle() is asked first if the probe matches.  Others
+    are still asked after that, probe_keys only change the order.
     """
 
-    # handle registration of subclasses
-    class __metaclass__(type):
-        def __new__(meta, name, bases, class_dict):
-            cls = type.__new__(meta, name, bases, class_dict)
-            if name != 'HandlerBase':
-                if hasattr(cls, '_generators'):
-                    cls._generators.append(cls)
-                else:
-                    # base class, don't register
-                    cls._generators = []
-            return cls
+    probe_keys = ()  # empty - may handle anything, see probe()
+
+    @staticmethod
+    def probe(opt):
+        """probe - cheap key for the input, root tag, file extension etc.,
+        for base classes to redefine
+
+        :param argparse Namespace opt: options
+        :return: key, or None
+        """
+
+        return None
+
+    @classmethod
+    def handlers(cls):
+        """handlers - subclasses of cls, depth first in definition order,
+        uses __subclasses__() rather than a (Python 2 only) metaclass
+
+        :return: generator of subclasses
+        """
+
+        for sub in cls.__subclasses__():
+            yield sub
+            for subsub in sub.handlers():
+                yield subsub
+
+    @classmethod
+    def probe_table(cls):
+        """probe_table - handlers indexed by their probe_keys, built once
+        per base class, on first use, when all subclasses are defined
+
+        :return: ({key: [handlers]}, [all handlers])
+        :rtype: tuple
+        """
+
+        if '_probe_table' not in cls.__dict__:  # not inherited
+            table = {}
+            handlers = list(cls.handlers())
+            for i in handlers:
+                for key in i.probe_keys:
+                    table.setdefault(key, []).append(i)
+            cls._probe_table = table, handlers
 
+        return cls._probe_table
 
     @classmethod
     def handle(cls, opt):
@@ -87,7 +175,11 @@ class HandlerBase(object):
         :return: ContentGenerator subclass instance
         """
 
-        for i in cls._generators:
+        table, handlers = cls.probe_table()
+        # candidates for probe() key first, then all the others, e.g. for
+        # a template with a wrapper or namespaced root
+        matched = table.get(cls.probe(opt), [])
+        for i in matched + [i for i in handlers if i not in matched]:
             if i.handle(opt):
                 return i(opt)
 
@@ -97,6 +189,17 @@ class ContainerParser(HandlerBase):
     """ContainerParser - Base class for handling containers (templates)
     """
 
+    @staticmethod
+    def probe(opt):
+        """probe - template root tag, see HandlerBase
+
+        :param argparse Namespace opt: options
+        :return: root tag
+        :rtype: str
+        """
+
+        return template_root_tag(opt)
+
 
     def __init__(self, opt):
         """
@@ -109,42 +212,96 @@ class ContainerParser(HandlerBase):
 class ContainerParserArcGIS(ContainerParser):
     """ContainerParserArcGIS - class for handling ArcGIS metadata XML
     """
-    def entities(self):
+
+    probe_keys = ('metadata',)
+    def entities(self, with_ele=False):
         """entities - list entities (feature classes, really) in template
 
-        :param book with_ele: include link to Element in dom
+        :param book with_ele: include link to Element in dom, as `_ELE`,
+            ignored when streaming, as elements are discarded
         """
 
+        if self.opt.dom is None:
+            return self.entities_stream()
+
+        if LXML:
+            found = XPATH_DETAILED(self.opt.dom)
+        else:
+            found = self.opt.dom.findall('.//eainfo/detailed')
         entities = []
-        for ele_entity in self.opt.dom.findall('.//eainfo/detailed'):
-            entity = {
-                'entity_name': ele_entity.findall('.//enttypl')[0].text,
-                'attributes': [],
-            }
-            entities.append(entity)
-            descrip = ele_entity.findall('.//enttypd')
-            if descrip and descrip[0].text.strip():
-                entity['entity_description'] = descrip[0].text.strip()
-
-            if self.opt.no_template_attributes:
-                continue
-
-            for ele_attribute in ele_entity.findall('.//attr'):
-                attribute = {
-                    'attribute_name': ele_attribute.findall('.//attrlabl')[0].text,
-                }
-                entity['attributes'].append(attribute)
-                for attrname, attrpath in [
-                    ('min', 'attrdomv/rdom/rdommin'),
-                    ('max', 'attrdomv/rdom/rdommax'),
-                    ('units', 'attrdomv/rdom/attrunit'),
-                    ('attribute_definition', 'attrdef'),
-                ]:
-                    attrval = ele_attribute.find(attrpath)
-                    if attrval is not None:
-                        attribute[attrname] = attrval.text
+        for ele_entity in found:
+            entities.append(self.entity(ele_entity, with_ele=with_ele))
 
         return entities
+    def entities_stream(self):
+        """entities_stream - like entities(), but use iterparse on
+        opt.template rather than a DOM, dropping each element from the
+        tree once it's ended, entity (`eainfo/detailed`) elements once
+        they're read, so memory use doesn't grow with template size
+        """
+
+        entities = []
+        stack = []  # open elements, root first
+        open_entities = []  # (element, index in entities) not yet ended
+        with open(self.opt.template, 'rb', BUFFER_SIZE) as template:
+            for event, ele in ElementTree.iterparse(
+                    template, events=('start', 'end'), **ITERPARSE_KWARGS):
+                if event == 'start':
+                    stack.append(ele)
+                    # as entities()' `.//eainfo/detailed`, below the root
+                    if (ele.tag == 'detailed' and len(stack) > 2 and
+                            stack[-2].tag == 'eainfo'):
+                        # placeholder, document order for nested entities
+                        open_entities.append((ele, len(entities)))
+                        entities.append(None)
+                    continue
+                stack.pop()
+                if open_entities and open_entities[-1][0] is ele:
+                    entities[open_entities.pop()[1]] = self.entity(ele)
+                # keep an entity's parts until it's read, parser may have
+                # read ahead, so remove `ele` rather than parent[-1]
+                if not open_entities and stack:
+                    stack[-1].remove(ele)
+
+        return entities
+    def entity(self, ele_entity, with_ele=False):
+        """entity - make entity dict from a `detailed` element
+
+        :param Element ele_entity: `detailed` element
+        :param book with_ele: include link to Element in dom, as `_ELE`
+        :return: entity (and attributes)
+        :rtype: dict
+        """
+
+        # .text, not findtext(), which gives '' for an empty element
+        name = ele_entity.find('enttyp/enttypl')
+        entity = {
+            'entity_name': name.text if name is not None else None,
+            'attributes': [],
+        }
+        if with_ele:
+            entity['_ELE'] = ele_entity
+        descrip = ele_entity.find('enttyp/enttypd')
+        if descrip is not None and descrip.text and descrip.text.strip():
+            entity['entity_description'] = descrip.text.strip()
+
+        if self.opt.no_template_attributes:
+            return entity
+
+        for ele_attribute in ele_entity.iterfind('attr'):
+            name = ele_attribute.find('attrlabl')
+            attribute = {
+                'attribute_name': name.text if name is not None else None,
+            }
+            if with_ele:
+                attribute['_ELE'] = ele_attribute
+            entity['attributes'].append(attribute)
+            for attrname, attrpath in ARCGIS_READ_PATHS:
+                attrval = ele_attribute.find(attrpath)
+                if attrval is not None:
+                    attribute[attrname] = attrval.text
+
+        return entity
     @staticmethod
     def handle(opt):
         """handle - see if this subclass handles content in opt
@@ -154,10 +311,45 @@ class ContainerParserArcGIS(ContainerParser):
         :rtype: bool
         """
 
-        return opt.dom.findall(".//Esri")
+        # memoized, ContentWriterArcGIS.handle() asks again
+        if getattr(opt, '_is_arcgis', None) is None:
+            if opt.dom is None:
+                # streaming, quick first pass looking for Esri element,
+                # dropping ended elements as in entities_stream()
+                opt._is_arcgis = False
+                stack = []  # open elements, root first
+                with open(opt.template, 'rb') as template:
+                    for event, ele in ElementTree.iterparse(
+                            template, events=('start', 'end'),
+                            **ITERPARSE_KWARGS):
+                        if event == 'start':
+                            if ele.tag == 'Esri':
+                                opt._is_arcgis = True
+                                break
+                            stack.append(ele)
+                            continue
+                        stack.pop()
+                        if stack:
+                            stack[-1].remove(ele)
+            else:
+                # stop at first Esri element, don't collect them all
+                opt._is_arcgis = next(opt.dom.iter('Esri'), None) is not None
+
+        return opt._is_arcgis
 class ContentGenerator(HandlerBase):
     """ContainerParser - Base class for generating content from input
     """
+
+    @staticmethod
+    def probe(opt):
+        """probe - content file extension, see HandlerBase
+
+        :param argparse Namespace opt: options
+        :return: lower case extension, e.g. '.csv'
+        :rtype: str
+        """
+
+        return os.path.splitext(opt.content or '')[1].lower()
     def __init__(self, opt):
         """
         :param argparse Namespace opt: options
@@ -168,6 +360,8 @@ class ContentGenerator(HandlerBase):
 class ContentGeneratorCSV(ContentGenerator):
     """ContentGeneratorCSV - read table attribute descriptions from .csv
     """
+
+    probe_keys = ('.csv',)
     def entities(self):
         """entities - return list of entities for this input, a (csv)
         table with rows describing fields.  The presence of a
@@ -177,28 +371,42 @@ class ContentGeneratorCSV(ContentGenerator):
 
         entities = []
         ent2list = {}  # don't add dupes when source tables/fields unsorted
-        reader = csv.reader(open(self.opt.content))
-        hdr = {i.lower():n for n,i in enumerate(next(reader))}
-        for row in reader:
-            # for table inputs describing multiple tables
-            row_name = get_val(row, 'entity_name', hdr)
-            if (not entities or
-                get_val(entities[using], 'entity_name') != row_name):
-                if row_name not in ent2list:
-                    entities.append({'entity_name': None, 'attributes': []})
-                    entities[-1]['entity_name'] = row_name
-                    ent2list[row_name] = len(entities) - 1
-                using = ent2list[row_name]
-            attributes = {k:row[hdr[k]] for k in hdr}
-            attribute_name = get_val(attributes, 'attribute_name')
-            if attribute_name:
-                entities[using]['attributes'].append(attributes)
-                # might just be a description of entities
-            for k in hdr:
-                if k.startswith('entity_') and row[hdr[k]].strip():
-                    # harmlessly copies entity_name over entity_name, needed
-                    # to copy entity_description in some contexts
-                    entities[using][k] = row[hdr[k]].strip()
+        tables = set(self.opt.tables) if self.opt.tables else None
+        with open(self.opt.content, 'rb', BUFFER_SIZE) as csv_file:
+            reader = csv.reader(csv_file)
+            header = map(str.lower, next(reader))
+            hdr = dict(zip(header, range(len(header))))
+            # work out column positions once, not per row
+            entity_col = _column_index(hdr, 'entity_name')
+            attribute_col = _column_index(hdr, 'attribute_name')
+            entity_cols = [(k, hdr[k]) for k in hdr if k.startswith('entity_')]
+            # canonical key for each column, so rows need no renaming
+            rename = {v: k for k, v in _canonicalize(
+                {i: i for i in header}).items()}
+            canon_header = [rename.get(i, i) for i in header]
+            extract = _row_extractor(canon_header)
+            current_name, using = None, -1
+            for row in reader:
+                # for table inputs describing multiple tables
+                row_name = row[entity_col] if entity_col is not None else None
+                if (tables is not None and row_name not in tables and
+                    (row_name or '').strip() not in tables):
+                    continue  # skip early, no need to build attributes
+                if using < 0 or row_name != current_name:
+                    using = ent2list.get(row_name)
+                    if using is None:
+                        entities.append(
+                            {'entity_name': row_name, 'attributes': []})
+                        using = ent2list[row_name] = len(entities) - 1
+                    current_name = row_name
+                if attribute_col is not None and row[attribute_col]:
+                    entities[using]['attributes'].append(extract(row))
+                # else might just be a description of entities
+                for k, col in entity_cols:
+                    if row[col].strip():
+                        # harmlessly copies entity_name over entity_name,
+                        # needed to copy entity_description in some contexts
+                        entities[using][k] = row[col].strip()
 
         if self.opt.tables:
             entities = [i for i in entities
@@ -218,6 +426,17 @@ class ContentGeneratorCSV(ContentGenerator):
 class ContentWriter(HandlerBase):
     """ContentWriter - write merged content
     """
+
+    @staticmethod
+    def probe(opt):
+        """probe - template root tag, see HandlerBase
+
+        :param argparse Namespace opt: options
+        :return: root tag
+        :rtype: str
+        """
+
+        return template_root_tag(opt)
     def __init__(self, opt):
         """
         :param argparse Namespace opt: options
@@ -229,6 +448,8 @@ class ContentWriter(HandlerBase):
 class ContentWriterArcGIS(ContentWriter):
     """ContentWriterArcGIS - write content to ESRI XML
     """
+
+    probe_keys = ContainerParserArcGIS.probe_keys
     @staticmethod
     def handle(opt):
         """handle - see if this subclass handles content in opt
@@ -243,52 +464,48 @@ class ContentWriterArcGIS(ContentWriter):
     def write(self, content):
         """write - write content into opt.dom
 
-        :param list content: merged content
+        :param list content: merged content, template entities and
+            attributes may have `_ELE` links to their Elements
         """
 
+        root = self.opt.dom.getroot()
+        path_cache = {}  # see make_path()
         for entity in content:
-            ent_path = make_path(
-                self.opt.dom.getroot(), 'eainfo/detailed', 'enttyp/enttypl',
-                get_val(entity, 'entity_name')
-            )
+            detailed = entity.get('_ELE')
+            if detailed is None:  # not from template
+                detailed = make_path(
+                    root, ('eainfo', 'detailed'), 'enttyp/enttypl',
+                    get_val(entity, 'entity_name'), cache=path_cache
+                )[-1]
 
             entity_description = get_val(entity, 'entity_description')
             if entity_description and entity_description.strip():
-                enttyp = ent_path[-1].find('enttyp')
+                enttyp = detailed.find('enttyp')
                 enttypd = enttyp.find('enttypd')
                 if enttypd is None:
                     enttypd = ElementTree.Element('enttypd')
                     enttyp.append(enttypd)
                 enttypd.text = entity_description
 
-            detailed = ent_path[-1]
             for attribute in entity['attributes']:
-                attr_path = make_path(
-                    detailed, 'attr', 'attrlabl',
-                    get_val(attribute, 'attribute_name')
-                )
-                attr = attr_path[-1]
-
-                for attrname, attrpath in [
-                    ('attribute_type', 'attrtype'),
-                    ('attribute_definition', 'attrdef'),
-                    ('min', 'attrdomv/rdom/rdommin'),
-                    ('max', 'attrdomv/rdom/rdommax'),
-                    ('units', 'attrdomv/rdom/attrunit'),
-                ]:
+                attr = attribute.get('_ELE')
+                if attr is None:  # not from template
+                    attr = make_path(
+                        detailed, ('attr',), 'attrlabl',
+                        get_val(attribute, 'attribute_name'),
+                        cache=path_cache
+                    )[-1]
+
+                for attrname, steps in ARCGIS_WRITE_PATHS:
                     attrval = get_val(attribute, attrname)
                     if attrval is not None and str(attrval).strip():
                         # 0 (zero) is a valid value
                         pos = attr
-                        steps = attrpath.split('/')
-                        while steps:
-                            step = steps.pop(0)
-                            if pos.find(step) is not None:
-                                pos = pos.find(step)
-                            else:
-                                ele = ElementTree.Element(step)
-                                pos.append(ele)
-                                pos = ele
+                        for step in steps:
+                            child = pos.find(step)
+                            if child is None:
+                                child = ElementTree.SubElement(pos, step)
+                            pos = child
                         pos.text = attrval
 def add_content(dom, opt):
     """add_content - Update dom with content from opt.content
@@ -312,28 +529,34 @@ def compare_data(opt, content):
     # re-arrange content as a dict
     content = {i['entity_name']:i['attributes'] for i in content}
     for key in list(content):
-        content[key] = {get_val(i, 'attribute_name'):i for i in content[key]}
+        content[key] = {i.get('attribute_name'):i for i in content[key]}
 
     # search opt.data for .csv files
     data = find_data(opt)
 
+    data_tables = set(data)
+    meta_tables = set(content)
+    common = sorted(data_tables & meta_tables)
+    msgs = []
+
     # look for tables / files without metadata
-    for table, fields in data.items():
-        if table not in content:
-            print "Data table '%s' not in metadata" % (table)
-            continue
-        for field in fields:
-            if field not in content[table]:
-                print "Data field '%s.%s' not in metadata" % (table, field)
+    msgs.extend("Data table '%s' not in metadata" % (table)
+                for table in sorted(data_tables - meta_tables))
+    for table in common:
+        missing = set(data[table]) - set(content[table])
+        msgs.extend("Data field '%s.%s' not in metadata" % (table, field)
+                    for field in sorted(missing))
 
     # look for metadata without tables / fields in data
-    for table, fields in content.items():
-        if table not in data:
-            print "Table metadata '%s' not in data" % (table)
-            continue
-        for field in fields:
-            if field not in data[table]:
-                print "Field metadata '%s.%s' not in data" % (table, field)
+    msgs.extend("Table metadata '%s' not in data" % (table)
+                for table in sorted(meta_tables - data_tables))
+    for table in common:
+        missing = set(content[table]) - set(data[table])
+        msgs.extend("Field metadata '%s.%s' not in data" % (table, field)
+                    for field in sorted(missing))
+
+    if msgs:
+        sys.stdout.write('\n'.join(msgs) + '\n')
 def do_update(old, new):
     """do_update - like dict.update(), but use canonical key names
 
@@ -344,37 +567,52 @@ def do_update(old, new):
 
     """
 
-    for newkey in new:
-
-        if not isinstance(new[newkey], (str, unicode)):
-            continue
+    for newkey, value in new.items():
 
-        if newkey.lower() in KEY_ALIASES:
-            old[newkey.lower()] = new[newkey]
+        if not isinstance(value, _TEXT_TYPES):
             continue
 
-        # check aliases
-        for key,keys in KEY_ALIASES.items():
-            if newkey.lower() in keys:
-                old[key] = new[newkey]
-                break
-        else:
-            old[newkey] = new[newkey]
+        # canonical key if newkey is one, or an alias for one, only
+        # lowercasing when the exact key isn't known
+        key = (_ALIAS2CANON.get(newkey) or
+               _ALIAS2CANON.get(newkey.lower()) or newkey)
+        if old.get(key) != value:  # skip no-op writes
+            old[key] = value
 def find_data(opt):
     data = {}
     if opt.data is None:
         return data
-    for path, dirs, files in os.walk(opt.data):
-        for file_ in files:
-            if file_.lower().endswith(".csv"):
-                filepath = os.path.join(path, file_)
-                reader = csv.reader(open(filepath))
-                data[file_[:-4]] = next(reader)
-                ## row_count = 0
-                ## for i in reader:
-                ##     row_count += 1
-                ## data[file_[:-4]+':row_count'] = str(row_count)
+    for filepath, file_ in find_csv(opt.data):
+        with open(filepath, 'rb') as csv_file:  # header only, no big buffer
+            reader = csv.reader(csv_file)
+            data[file_[:-4]] = next(reader)
+            ## row_count = 0
+            ## for i in reader:
+            ##     row_count += 1
+            ## data[file_[:-4]+':row_count'] = str(row_count)
     return data
+def find_csv(path):
+    """find_csv - recursively find .csv files, using scandir() if
+    available to avoid a stat() per directory entry
+
+    :param str path: directory to search
+    :return: generator of (path, filename) tuples
+    """
+
+    if scandir is None:
+        for path, dirs, files in os.walk(path):
+            for file_ in files:
+                if file_.lower().endswith(".csv"):
+                    yield os.path.join(path, file_), file_
+        return
+
+    for entry in scandir(path):
+        # check extension first, no stat() needed for that
+        if entry.name.lower().endswith(".csv") and entry.is_file():
+            yield entry.path, entry.name
+        elif entry.is_dir(follow_symlinks=False):
+            for found in find_csv(entry.path):
+                yield found
 def get_val(source, key, hdr=None):
     """get_val - get a value from source with aliases
 
@@ -384,15 +622,12 @@ def get_val(source, key, hdr=None):
     """
 
     if hdr:
-        source = {key:source[col] for key,col in hdr.items()}
+        # list source, index columns directly rather than building a dict
+        col = _column_index(hdr, key)
+        return None if col is None else source[col]
 
-    if key in source:
-        # give exact match precedence
-        return source[key]
-
-    # check aliases
-    keys = KEY_ALIASES.get(key, [])
-    for key in keys:
+    # exact match first, then aliases
+    for key in _CANON_KEYS.get(key, (key,)):
         if key in source:
             return source[key]
 
@@ -423,13 +658,20 @@ def make_parser():
 
     parser.add_argument('--no-template-attributes', action='store_true',
         help="ignore (and drop) all attribute level metadata in template")
+    parser.add_argument('--stream', action='store_true',
+        help="stream the template instead of loading it into memory, "
+             "for large templates, not used with --output")
+    parser.add_argument('--jobs', type=int, default=1,
+        help="read --content files in this many processes, for many "
+             "large content files")
 
     return parser
-def make_path(dom, path, textpath, text):
+def make_path(dom, path, textpath, text, cache=None):
     """make_path - find or make a path of XML elements ending
     in one with `text` as its text content (maybe in a subpath) e.g.:
 
     call: dom, 'eainfo/detailed', 'enttyp/enttypl', 'MyTable'
+      or: dom, ('eainfo', 'detailed'), 'enttyp/enttypl', 'MyTable'
 
     returns: [<Element:eainfo>, <Element:datailed>]
 
@@ -437,76 +679,149 @@ def make_path(dom, path, textpath, text):
     `enttypl` with text 'MyTable'
 
     :param XML dom: XML to search / edit
-    :param str path: XPath like path to target container
+    :param str/tuple path: XPath like path to target container, or
+        tuple of its steps, pre-split by callers making repeated calls
     :param str textpath: more XPath like path to element containing name
     :param str text: text (name) to place in last element
+    :param dict cache: optional, pass the same dict to repeated calls to
+        avoid rescanning candidates, maps (container, step, textpath) to
+        {text: element}
     """
 
-    steps = path.split('/')
+    steps = path.split('/') if isinstance(path, _TEXT_TYPES) else path
     path = [dom]
-    while steps:
-        step = steps.pop(0)
-        next = path[-1].findall('.//'+step)
-        if not steps:
-            break  # next is list of possibles
-        if next:
-            assert len(next) == 1, path
-            path.append(next[0])
-        else:  # add intermediates if needed
-            ele = ElementTree.Element(step)
-            path[-1].append(ele)
-            path.append(ele)
-    # end with `next` list of possibles
-
-    for test in next:
-        if textpath:
-            src = test.findall(textpath)
-            assert len(src) == 1, (src, path, next, textpath)
-            value = src[0].text
-        else:
-            value = test.text
-        if value == text:
-            path.append(test)
-            break
+    # direct children first, `path` is normally a path from `dom`
+    for step in steps[:-1]:
+        child = path[-1].find(step)
+        if child is None:  # not a direct child, e.g. under a wrapper root
+            child = path[-1].find('.//' + step)
+        if child is None:  # add intermediates if needed
+            child = ElementTree.SubElement(path[-1], step)
+        path.append(child)
+    step = steps[-1]
+
+    # index possibles by text, key on the container element itself, not
+    # id(), as lxml may recycle Python proxies for elements
+    key = (path[-1], step, textpath)
+    possibles = cache.get(key) if cache is not None else None
+    if possibles is None:
+        possibles = {}
+        for test in path[-1].iterfind(step):
+            if textpath:
+                src = test.findall(textpath)
+                assert len(src) == 1, (src, path, textpath)
+                value = src[0].text
+            else:
+                value = test.text
+            possibles.setdefault(value, test)  # first match wins
+        if cache is not None:
+            cache[key] = possibles
+
+    if text in possibles:
+        path.append(possibles[text])
     else:
-        text_holder = ElementTree.Element(step)
-        path[-1].append(text_holder)
+        text_holder = ElementTree.SubElement(path[-1], step)
         path.append(text_holder)
+        possibles[text] = text_holder
         for step in textpath.split('/'):
-            new = ElementTree.Element(step)
-            text_holder.append(new)
-            text_holder = new
-        new.text = text
+            text_holder = ElementTree.SubElement(text_holder, step)
+        text_holder.text = text
 
     return path
-def merge_content(old, new, names, sublists=None):
+def merge_content(old, new, names, sublists=None, copy=True):
     """merge_content - merge data from content into data from template
 
     :param list old: elements (feature classes), or attributes
     :param lsit new: elements (feaures classes), or attributes
+    :param bool copy: copy `old`, False to update it in place, as when
+        recursing into sublists already copied
     :return: merged list
     """
 
-    merged = deepcopy(old)
-    to_append = []  # at end, not while iterating
+    merged = _clone_entities(old) if copy else old
+
+    # index by name, resolving aliases once per item, first one wins
+    index = {}
+    for i_old in merged:
+        index.setdefault(get_val(i_old, names[0]), i_old)
 
     for i_new in new:
-        found = False
-        for i_old in merged:
-            if get_val(i_old, names[0]) == get_val(i_new, names[0]):
-                found = True
-                do_update(i_old, i_new)  # scalar values only
-                if len(names) > 1:
-                    i_old[sublists[1]] = merge_content(
-                        i_old[sublists[1]], i_new[sublists[1]],
-                        names[1:], sublists[1:])
+        name = get_val(i_new, names[0])
+        i_old = index.get(name)
+        if i_old is None:
+            # copy and index, so later items with this name merge into it
+            i_old = index[name] = _clone_entities([i_new])[0]
+            merged.append(i_old)
+            continue
+        do_update(i_old, i_new)  # scalar values only
+        if len(names) > 1:
+            # i_old is already a copy, including its sublist
+            i_old[sublists[1]] = merge_content(
+                i_old[sublists[1]], i_new[sublists[1]],
+                names[1:], sublists[1:], copy=False)
+
+    return merged
+def _canonicalize(attribute):
+    """_canonicalize - rename aliased keys in an attribute dict to their
+    canonical names, in place, so later code can use attribute.get(key)
+    rather than get_val().  Precedence matches get_val(), entity level
+    keys ('table' etc.) are left alone
+
+    :param dict attribute: attribute to update
+    :return: attribute
+    :rtype: dict
+    """
+
+    for canon, keys in _CANON_KEYS.items():
+        if canon.startswith('entity_') or canon in attribute:
+            continue
+        for key in keys[1:]:
+            if key in attribute:
+                attribute[canon] = attribute.pop(key)
                 break
-        if not found:
-            to_append.append(i_new)
 
-    merged.extend(to_append)
+    return attribute
+def _column_index(hdr, key):
+    """_column_index - column for key, or its first alias present, in
+    a CSV header
 
-    return merged
+    :param dict hdr: map key names to column numbers
+    :param str key: (canonical) key
+    :return: column number, or None
+    """
+
+    for key in _CANON_KEYS.get(key, (key,)):
+        if key in hdr:
+            return hdr[key]
+
+    return None
+def _clone_entities(items):
+    """_clone_entities - copy a list of entities (or attributes), much
+    quicker than deepcopy(), as they're just dicts of strings with an
+    `attributes` list of dicts of strings
+
+    :param list items: entities or attributes
+    :return: copy of items
+    :rtype: list
+    """
+
+    clones = []
+    for item in items:
+        clone = dict(item)
+        if 'attributes' in clone:
+            clone['attributes'] = [dict(i) for i in clone['attributes']]
+        clones.append(clone)
+
+    return clones
+def _content_entities(opt):
+    """_content_entities - entities from a single content file, at
+    module level so multiprocessing workers can call it
+
+    :param argparse Namespace opt: options, opt.content one file
+    :return: list of entities
+    """
+
+    return ContentGenerator.handle(opt).entities()
 def missing_content(opt, content):
     """missing_content - make table for --content for missing info.
 
@@ -518,7 +833,7 @@ def missing_content(opt, content):
     full_content = content  # save for entity descriptions below
     content = {i['entity_name']:i['attributes'] for i in content}
     for key in list(content):
-        content[key] = {get_val(i, 'attribute_name'):i for i in content[key]}
+        content[key] = {i.get('attribute_name'):i for i in content[key]}
 
     # search opt.data for .csv files
     data = find_data(opt)
@@ -531,6 +846,12 @@ def missing_content(opt, content):
         metafields = set()
         for records in content[table].values():
             metafields.update(records.keys())
+        # canonical key -> alias for it in use
+        in_use = {}
+        for alias in metafields:
+            canon = _ALIAS2CANON.get(alias)
+            if canon and canon != alias:
+                in_use.setdefault(canon, alias)
         for field in fields:
             if field not in content[table]:
                 fieldinfo = {}
@@ -538,8 +859,8 @@ def missing_content(opt, content):
                 for key in KEY_ALIASES:
                     if key.startswith('entity_'):
                         continue
-                    set_val(key, metafields, fieldinfo, '')
-                set_val('attribute_name', metafields, fieldinfo, field)
+                    set_val(key, in_use, fieldinfo, '')
+                set_val('attribute_name', in_use, fieldinfo, field)
 
     # now write out the --content table again
     metafields = set()
@@ -547,50 +868,102 @@ def missing_content(opt, content):
         for fieldinfo in table.values():
             metafields.update(fieldinfo.keys())
 
-    metafields = [i for i in metafields if not i.startswith("entity_")]
-    writer = csv.writer(open(opt.missing_content, 'wb'))
-    writer.writerow(['entity_name']+metafields)
-    for table, fields in content.items():
-        for field in fields.values():
-            row = [table] + [field.get(k) for k in metafields]
-            writer.writerow(row)
+    # skip entity level and private (_ELE etc.) keys
+    metafields = [i for i in metafields
+                  if not i.startswith("entity_") and not i.startswith('_')]
+    rows = [['entity_name']+metafields]
+    rows.extend(
+        [table] + [field.get(k) for k in metafields]
+        for table, fields in content.items()
+        for field in fields.values()
+    )
+    with open(opt.missing_content, 'wb', BUFFER_SIZE) as out:
+        csv.writer(out).writerows(rows)
     # write out entity descriptions
     missing_ents = "%s_ents.%s" % tuple(opt.missing_content.rsplit('.', 1))
-    writer = csv.writer(open(missing_ents, 'wb'))
-    writer.writerow(['entity_name', 'entity_description'])
-    for entity in full_content:
-        row = [
-            (get_val(entity, i) or '')
-            for i in ('entity_name', 'entity_description')]
-        # could be ascii/utf-8 OR CP-1252
-        for n in range(len(row)):
-            try:
-                row[n] = row[n].encode('utf-8')
-            except UnicodeDecodeError:
-                row[n] = row[n].decode('windows-1252').encode('utf-8')
-        writer.writerow(row)
-def set_val(key, metafields, fieldinfo, value):
+    rows = [['entity_name', 'entity_description']]
+    rows.extend(
+        [_to_utf8(get_val(entity, i) or '')
+         for i in ('entity_name', 'entity_description')]
+        for entity in full_content
+    )
+    with open(missing_ents, 'wb', BUFFER_SIZE) as out:
+        csv.writer(out).writerows(rows)
+def _row_extractor(header):
+    """_row_extractor - compile a function turning a CSV row into a dict
+    keyed on header, indexing row[0], row[1]... directly, much quicker
+    than dict(zip(header, row)) per row, which is still used for rows
+    shorter or longer than the header
+
+    :param list header: (canonical) key for each column
+    :return: function(row) -> dict
+    """
+
+    src = "def extract(row):\n" \
+          "    if len(row) != %d:\n" \
+          "        return dict(zip(header, row))\n" \
+          "    return {%s}\n" % (len(header), ', '.join(
+              "%r: row[%d]" % (key, col) for col, key in enumerate(header)))
+    namespace = {'header': list(header)}
+    exec(compile(src, '<_row_extractor>', 'exec'), namespace)
+    return namespace['extract']
+def set_val(key, in_use, fieldinfo, value):
     """
     set_val - set a value in a dict of field metadata, using
-    aliases from KEY_ALIASES if they're already in metafields
+    aliases from KEY_ALIASES if they're already in use
 
-    :param str key: the key to set
-    :param set(str) metafields: fields already in use
+    :param str key: the (canonical) key to set
+    :param dict in_use: canonical key -> alias already in use
     :param dict fieldinfo: dict to add key:value too
     :param str value: value to add
     """
 
-    for alias in metafields:
-        if alias in KEY_ALIASES[key]:
-            key = alias
-            break
-    fieldinfo[key] = value
+    fieldinfo[in_use.get(key, key)] = value
+def template_root_tag(opt):
+    """template_root_tag - tag of template's root element, memoized
+
+    :param argparse Namespace opt: options
+    :return: root tag
+    :rtype: str
+    """
+
+    if getattr(opt, '_root_tag', None) is None:
+        if opt.dom is None:
+            # streaming, read just the first element
+            with open(opt.template, 'rb') as template:
+                event, root = next(iter(ElementTree.iterparse(
+                    template, events=('start',), **ITERPARSE_KWARGS)))
+        else:
+            root = opt.dom.getroot()
+        opt._root_tag = root.tag
+
+    return opt._root_tag
+def _to_utf8(text):
+    """_to_utf8 - encode text as utf-8, text may be unicode, or bytes
+    which could be ascii/utf-8 OR CP-1252
+
+    :param str/unicode text: text to encode
+    :return: utf-8 encoded text
+    :rtype: str
+    """
+
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    try:
+        text.decode('utf-8')
+        return text  # already ascii/utf-8
+    except UnicodeDecodeError:
+        return text.decode('windows-1252').encode('utf-8')
 
 def main():
     """read args, load template, update, (over)write output"""
     opt = make_parser().parse_args()
     if opt.template:
-        opt.dom = ElementTree.parse(opt.template)
+        if opt.stream and not opt.output:
+            opt.dom = None  # ContainerParser will iterparse opt.template
+        else:
+            with open(opt.template, 'rb', BUFFER_SIZE) as template:
+                opt.dom = ElementTree.parse(template, **PARSE_KWARGS)
     # add_content(dom, opt)
     if opt.output and os.path.exists(opt.output) and not opt.overwrite:
         raise IOError(
@@ -604,13 +977,31 @@ def main():
                    # info. from content, and those two merged
 
     if opt.template:
-        template = ContainerParser.handle(opt).entities()
+        # writer can use links to template Elements
+        template = ContainerParser.handle(opt).entities(
+            with_ele=bool(opt.output))
         datasets.append(template)
     if opt.content:
-        content = []
+        # options per content file, without the DOM, which workers
+        # don't need and can't be pickled
+        file_opts = []
         for file_ in opt.content:
-            opt.content = file_
-            subcontent = ContentGenerator.handle(opt).entities()
+            file_opt = argparse.Namespace(**vars(opt))
+            file_opt.content = file_
+            file_opt.dom = None
+            file_opts.append(file_opt)
+        if opt.jobs > 1 and len(file_opts) > 1:
+            pool = multiprocessing.Pool(min(opt.jobs, len(file_opts)))
+            try:
+                subcontents = pool.map(_content_entities, file_opts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            subcontents = map(_content_entities, file_opts)
+        # merge serially, in --content order
+        content = []
+        for subcontent in subcontents:
             content = merge_content(content, subcontent,
                 ['entity_name', 'attribute_name'], [None, 'attributes'])
         datasets.append(content)
@@ -636,14 +1027,12 @@ def main():
             print "Can't use --output without --template"
             exit(10)
 
-        # content from template
-        template = ContainerParser.handle(opt).entities()
-        # new content
-        content = ContentGenerator.handle(opt).entities()
-
+        # template and content were read and merged above, writer
+        # puts merged into the already parsed opt.dom
         writer = ContentWriter.handle(opt)
         writer.write(merged)
-        opt.dom.write(open(opt.output, 'wb'), encoding='utf-8')
+        with open(opt.output, 'wb', BUFFER_SIZE) as out:
+            opt.dom.write(out, encoding='utf-8', xml_declaration=True)
 
         return
 